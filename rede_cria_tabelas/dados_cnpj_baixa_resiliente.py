@@ -4,9 +4,12 @@ Script para download resiliente de dados públicos do CNPJ.
 Verifica arquivos existentes, retoma downloads e valida integridade.
 """
 from bs4 import BeautifulSoup
-import requests, os, time, zipfile
+import requests, os, time, zipfile, asyncio, json
+import aiohttp, aiofiles
+from concurrent.futures import ProcessPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from tqdm import tqdm
-from tqdm.contrib.concurrent import thread_map
 
 
 url_dados_abertos = "https://arquivos.receitafederal.gov.br/cnpj/dados_abertos_cnpj/"
@@ -19,6 +22,26 @@ headers = {
 }
 max_tentativas = 3  # Número máximo de tentativas por arquivo
 max_concorrentes = 4  # Número de downloads simultâneos
+max_partes = 4  # Número de requisições Range paralelas por arquivo
+
+# Sessão única para as chamadas HTTP síncronas (listagem e sondagens de tamanho):
+# reaproveita conexões TCP/TLS com o host da Receita em vez de abrir uma por chamada
+SESSION = requests.Session()
+SESSION.headers.update(headers)
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=8,
+        pool_maxsize=16,
+        max_retries=Retry(
+            total=5,
+            backoff_factor=1.5,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset(["GET", "HEAD"]),
+            respect_retry_after_header=True,
+        ),
+    ),
+)
 
 
 def requisitos():
@@ -27,19 +50,41 @@ def requisitos():
     os.makedirs(pasta_zip, exist_ok=True)
 
 
-def get_remote_file_size(url):
-    """Obtém o tamanho remoto do arquivo."""
+def probe_remote(url):
+    """Sonda o arquivo remoto via HEAD, sem abrir o corpo da resposta.
+    Retorna (tamanho, etag); tamanho -1 indica falha."""
     try:
-        response = requests.head(url, headers=headers, allow_redirects=True, timeout=30)
+        response = SESSION.head(url, allow_redirects=True, timeout=30)
         if response.status_code == 200:
-            return int(response.headers.get("Content-Length", 0))
-    except:
-        pass
-    return 0
+            return (
+                int(response.headers.get("Content-Length", 0)),
+                response.headers.get("ETag"),
+            )
+    except Exception as e:
+        print(f"⚠️  Erro ao obter informações remotas: {str(e)}")
+    return -1, None
+
+
+# Manifesto com o ETag de cada arquivo: permite retomar um download parcial
+# com If-Range em vez de recomeçar do zero quando o tamanho local difere
+manifest_path = os.path.join(pasta_zip, ".manifest.json")
+
+
+def carrega_manifest():
+    try:
+        with open(manifest_path, "r") as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
+
+def salva_manifest(manifest):
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=1)
 
 
 def is_zip_valid(file_path):
-    """Verifica se o arquivo ZIP é válido."""
+    """Verifica se o arquivo ZIP é válido (CRC de todos os membros, custoso)."""
     try:
         with zipfile.ZipFile(file_path, "r") as zip_ref:
             return zip_ref.testzip() is None
@@ -47,85 +92,287 @@ def is_zip_valid(file_path):
         return False
 
 
-def get_remote_file_size(url):
-    """Obtém o tamanho remoto do arquivo de forma robusta."""
+def is_zip_structurally_ok(file_path):
+    """Verificação barata: só lê o diretório central no fim do arquivo,
+    sem descompactar os membros. Suficiente para decidir se refaz o download;
+    a checagem completa de CRC (is_zip_valid) fica para depois de baixar."""
     try:
-        with requests.get(url, headers=headers, stream=True, timeout=15) as response:
-            if response.status_code == 200:
-                return int(response.headers.get("Content-Length", 0))
-    except Exception as e:
-        print(f"⚠️  Erro ao obter tamanho remoto: {str(e)}")
-    return -1  # Indica falha
+        with zipfile.ZipFile(file_path, "r") as zip_ref:
+            return len(zip_ref.namelist()) > 0
+    except:
+        return False
+
+
+class RangeNaoSuportado(Exception):
+    """Servidor respondeu 200 em vez de 206: refazer em fluxo único."""
 
 
-def download_file(url, filename):
-    """Baixa o arquivo com tratamento robusto de erros."""
+async def aceita_range(session, url):
+    """Verifica via HEAD se o servidor aceita requisições parciais (Range)."""
+    try:
+        async with session.head(url, allow_redirects=True) as response:
+            return response.headers.get("Accept-Ranges", "").lower() == "bytes"
+    except Exception:
+        return False
+
+
+def _divide_partes(remote_size, n):
+    """Divide [0, remote_size) em n faixas aproximadamente iguais."""
+    tamanho_parte = remote_size // n
+    partes = []
+    for k in range(n):
+        inicio = k * tamanho_parte
+        fim = remote_size - 1 if k == n - 1 else (k + 1) * tamanho_parte - 1
+        partes.append({"inicio": inicio, "fim": fim, "baixado": 0})
+    return partes
+
+
+def _carrega_partes(parts_path, remote_size):
+    """Recupera o progresso das partes do sidecar .parts.json, se compatível."""
+    try:
+        with open(parts_path, "r") as f:
+            dados = json.load(f)
+        if dados.get("remote_size") == remote_size:
+            return dados["partes"]
+    except Exception:
+        pass
+    return _divide_partes(remote_size, max_partes)
+
+
+def _salva_partes(parts_path, remote_size, partes):
+    with open(parts_path, "w") as f:
+        json.dump({"remote_size": remote_size, "partes": partes}, f)
+
+
+async def _baixa_parte(session, url, fd, parte, bar):
+    """Baixa uma faixa de bytes e grava na região correspondente do arquivo."""
+    inicio = parte["inicio"] + parte["baixado"]
+    if inicio > parte["fim"]:
+        return  # parte já concluída em execução anterior
+    faixa = {"Range": f"bytes={inicio}-{parte['fim']}"}
+    async with session.get(url, headers=faixa) as response:
+        # erros (429, 5xx etc.) seguem para o backoff normal e retomam das
+        # partes salvas; só um 200 significa que o servidor ignorou o Range
+        response.raise_for_status()
+        if response.status != 206:
+            raise RangeNaoSuportado(f"Range não suportado (HTTP {response.status})")
+        offset = inicio
+        async for chunk in response.content.iter_chunked(1 << 20):
+            os.pwrite(fd, chunk, offset)
+            offset += len(chunk)
+            parte["baixado"] = offset - parte["inicio"]
+            bar.update(len(chunk))
+
+
+async def download_file_em_partes(session, url, filename, file_path, remote_size):
+    """Baixa o arquivo com várias requisições Range paralelas, com retomada por parte."""
+    parts_path = file_path + ".parts.json"
+    partes = _carrega_partes(parts_path, remote_size)
+
+    # pré-aloca o arquivo para que as partes possam gravar em offsets concorrentes
+    if not os.path.exists(file_path) or os.path.getsize(file_path) != remote_size:
+        partes = _divide_partes(remote_size, max_partes)
+        with open(file_path, "wb") as f:
+            try:
+                os.posix_fallocate(f.fileno(), 0, remote_size)
+            except (AttributeError, OSError):
+                f.truncate(remote_size)
+
+    # grava o sidecar já no início: ele marca o download como "em andamento",
+    # senão um encerramento abrupto deixaria o arquivo pré-alocado (tamanho
+    # final, faixas ainda zeradas) passando pelas verificações de arquivo OK
+    _salva_partes(parts_path, remote_size, partes)
+
+    ja_baixado = sum(p["baixado"] for p in partes)
+    fd = os.open(file_path, os.O_WRONLY)
+    try:
+        with tqdm(
+            desc=filename,
+            total=remote_size,
+            initial=ja_baixado,
+            unit="B",
+            unit_scale=True,
+            unit_divisor=1024,
+        ) as bar:
+            async with asyncio.TaskGroup() as tg:
+                for parte in partes:
+                    tg.create_task(_baixa_parte(session, url, fd, parte, bar))
+    except BaseExceptionGroup as eg:
+        # persiste o progresso para retomar apenas as faixas inacabadas
+        _salva_partes(parts_path, remote_size, partes)
+        raise eg.exceptions[0] from None
+    except BaseException:
+        _salva_partes(parts_path, remote_size, partes)
+        raise
+    finally:
+        os.close(fd)
+
+    if os.path.exists(parts_path):
+        os.remove(parts_path)
+
+
+async def download_file(session, url, filename, remote_size, etag, sem, pool):
+    """Baixa o arquivo com tratamento robusto de erros.
+
+    remote_size e etag vêm da sondagem feita uma única vez em main(),
+    evitando um novo round trip HTTP por arquivo.
+    """
     file_path = os.path.join(pasta_zip, filename)
 
-    # Verificação inicial
-    remote_size = get_remote_file_size(url)
     if remote_size == -1:
         print(f"❌ Não foi possível obter informações de {filename}")
         return False
 
-    # Se o arquivo local existe e é válido, pula
+    # os.pwrite não existe no Windows; sem ele, fica no caminho de fluxo único
+    usa_partes = (
+        remote_size > 0
+        and hasattr(os, "pwrite")
+        and await aceita_range(session, url)
+    )
+    manifest = carrega_manifest()
+    etag_confere = etag is not None and manifest.get(filename) == etag
+
+    # Se o arquivo local existe e é válido, pula. Um sidecar .parts.json
+    # presente indica download em andamento: o arquivo é pré-alocado no
+    # tamanho final e o diretório central pode já estar gravado no rodapé,
+    # então tamanho e estrutura parecem OK mesmo com faixas ainda zeradas —
+    # nesse caso o atalho nunca vale
+    partes_pendentes = os.path.exists(file_path + ".parts.json")
     if os.path.exists(file_path):
-        if os.path.getsize(file_path) == remote_size and is_zip_valid(file_path):
+        if (
+            not partes_pendentes
+            and os.path.getsize(file_path) == remote_size
+            and is_zip_structurally_ok(file_path)
+        ):
             print(f"⏩ {filename} já está OK.")
             return True
+        elif usa_partes and etag_confere and partes_pendentes:
+            print(f"🔁 {filename} com download parcial. Retomando partes inacabadas.")
+        elif (
+            not usa_partes
+            and not partes_pendentes
+            and etag_confere
+            and 0 < os.path.getsize(file_path) < remote_size
+        ):
+            print(f"🔁 {filename} parcial com ETag válido. Retomando via If-Range.")
         else:
             print(f"⚠️  {filename} incompleto/corrompido. Reiniciando download.")
             os.remove(file_path)
+            if partes_pendentes:
+                os.remove(file_path + ".parts.json")
+
+    # registra o ETag desta versão do arquivo antes de começar a gravar
+    if etag and manifest.get(filename) != etag:
+        manifest[filename] = etag
+        salva_manifest(manifest)
 
-    # Tenta baixar do zero
+    # Tenta baixar; o semáforo cobre apenas a transferência, para que a
+    # validação de CRC de um arquivo não ocupe a vaga do download seguinte
     for tentativa in range(1, max_tentativas + 1):
         try:
             # print(f"\n📥 Tentativa {tentativa}/{max_tentativas} para {filename}")
-            with requests.get(
-                url, headers=headers, stream=True, timeout=60
-            ) as response:
-                response.raise_for_status()
-                total_size = int(response.headers.get("Content-Length", 0))
-
-                with open(file_path, "wb") as f, tqdm(
-                    desc=filename,
-                    total=total_size,
-                    unit="B",
-                    unit_scale=True,
-                    unit_divisor=1024,
-                ) as bar:
-                    for chunk in response.iter_content(chunk_size=8192):
-                        if chunk:
-                            f.write(chunk)
-                            bar.update(len(chunk))
-
-            # Validação rigorosa
-            if is_zip_valid(file_path) and os.path.getsize(file_path) == remote_size:
+            async with sem:
+                if usa_partes:
+                    await download_file_em_partes(
+                        session, url, filename, file_path, remote_size
+                    )
+                else:
+                    local_size = (
+                        os.path.getsize(file_path) if os.path.exists(file_path) else 0
+                    )
+                    cabecalhos = {}
+                    if etag_confere and 0 < local_size < remote_size:
+                        # retoma do byte local_size; If-Range garante que o servidor
+                        # só responde 206 se o arquivo remoto ainda for o mesmo
+                        cabecalhos = {
+                            "Range": f"bytes={local_size}-",
+                            "If-Range": etag,
+                        }
+                    async with session.get(url, headers=cabecalhos) as response:
+                        response.raise_for_status()
+                        retomando = response.status == 206
+
+                        if not retomando:
+                            # pré-aloca o arquivo inteiro: layout contíguo no disco
+                            # e sem atualização de extents a cada chunk gravado
+                            with open(file_path, "wb") as f_pre:
+                                try:
+                                    os.posix_fallocate(f_pre.fileno(), 0, remote_size)
+                                except (AttributeError, OSError):
+                                    f_pre.truncate(remote_size)
+
+                        escrito = local_size if retomando else 0
+                        try:
+                            async with aiofiles.open(file_path, "r+b") as f:
+                                await f.seek(escrito)
+                                with tqdm(
+                                    desc=filename,
+                                    total=remote_size,
+                                    initial=escrito,
+                                    unit="B",
+                                    unit_scale=True,
+                                    unit_divisor=1024,
+                                ) as bar:
+                                    async for chunk in response.content.iter_chunked(
+                                        1 << 20
+                                    ):
+                                        await f.write(chunk)
+                                        escrito += len(chunk)
+                                        bar.update(len(chunk))
+                        except BaseException:
+                            # descarta a pré-alocação além do que foi gravado,
+                            # para que a retomada via If-Range continue correta
+                            with open(file_path, "r+b") as f_trunc:
+                                f_trunc.truncate(escrito)
+                            raise
+
+            # Validação rigorosa: o CRC completo roda no pool de processos,
+            # em paralelo com os downloads dos demais arquivos
+            loop = asyncio.get_running_loop()
+            valido = await loop.run_in_executor(pool, is_zip_valid, file_path)
+            if valido and os.path.getsize(file_path) == remote_size:
                 # print(f"✅ {filename} validado com sucesso!")
                 return True
-            else:
-                raise Exception("Arquivo corrompido após download")
+            print(f"⚠️  Tentativa {tentativa}: arquivo corrompido após download.")
+            os.remove(file_path)
+            if os.path.exists(file_path + ".parts.json"):
+                os.remove(file_path + ".parts.json")
 
+        except RangeNaoSuportado as e:
+            print(f"⚠️  {filename}: {str(e)}. Refazendo em fluxo único.")
+            usa_partes = False
+        except aiohttp.ClientResponseError as e:
+            print(f"⚠️  Falha na tentativa {tentativa}: {str(e)}")
+            if not usa_partes and not etag_confere and os.path.exists(file_path):
+                os.remove(file_path)
+            if tentativa < max_tentativas:
+                # backoff exponencial; em 429 respeita o Retry-After do servidor
+                espera = 1.5 * 2 ** (tentativa - 1)
+                if e.status == 429:
+                    # Retry-After pode vir em segundos ou como data HTTP;
+                    # só a forma numérica interessa, o resto fica no backoff
+                    retry_after = (e.headers or {}).get("Retry-After", "")
+                    if retry_after.strip().isdigit():
+                        espera = max(espera, float(retry_after))
+                    print(f"⏳ HTTP 429 em {filename}, aguardando {espera:.0f}s...")
+                await asyncio.sleep(espera)
         except Exception as e:
             print(f"⚠️  Falha na tentativa {tentativa}: {str(e)}")
-            if os.path.exists(file_path):
+            if not usa_partes and not etag_confere and os.path.exists(file_path):
                 os.remove(file_path)
+            if tentativa < max_tentativas:
+                await asyncio.sleep(1.5 * 2 ** (tentativa - 1))
 
     print(f"❌ Falha definitiva em {filename} após {max_tentativas} tentativas.")
     return False
 
 
-def baixar_com_args(args):
-    url, filename = args
-    return download_file(url, filename)
-
-
-def main():
+async def main():
     requisitos()
     print(f"\n{time.asctime()} - Iniciando...")
 
     # Obtém lista de arquivos
-    soup = BeautifulSoup(requests.get(url_dados_abertos).text, "lxml")
+    soup = BeautifulSoup(SESSION.get(url_dados_abertos, timeout=30).text, "lxml")
     ultima_referencia = sorted(
         [
             link.get("href")
@@ -134,7 +381,7 @@ def main():
         ]
     )[-1]
     url = url_dados_abertos + ultima_referencia
-    soup = BeautifulSoup(requests.get(url).text, "lxml")
+    soup = BeautifulSoup(SESSION.get(url, timeout=30).text, "lxml")
 
     lista = [
         url + link["href"] if not link["href"].startswith("http") else link["href"]
@@ -146,16 +393,20 @@ def main():
     for url in lista:
         print(f"🔗 {url}")
 
-    # Filtra arquivos já válidos
+    # Filtra arquivos já válidos, sondando tamanho e ETag uma única vez por url
+    sondagens = {url: probe_remote(url) for url in lista}
     arquivos_para_baixar = []
     for url in lista:
         filename = os.path.basename(url)
-        remote_size = get_remote_file_size(url)
         file_path = os.path.join(pasta_zip, filename)
 
-        if os.path.exists(file_path):
+        # um sidecar .parts.json indica download em andamento: o arquivo é
+        # pré-alocado no tamanho final, então as verificações abaixo passariam
+        if os.path.exists(file_path) and not os.path.exists(
+            file_path + ".parts.json"
+        ):
             local_size = os.path.getsize(file_path)
-            if local_size == remote_size and is_zip_valid(file_path):
+            if local_size == sondagens[url][0] and is_zip_structurally_ok(file_path):
                 print(f"⏩ {filename} já está OK. Pulando.")
                 continue
         arquivos_para_baixar.append((url, filename))
@@ -168,16 +419,29 @@ def main():
             f"\n🚀 Iniciando download de {total} arquivos com até {max_concorrentes} simultâneos...\n"
         )
 
-        # dispara os downloads em paralelo e coleta True/False
-        resultados = thread_map(
-            baixar_com_args,
-            arquivos_para_baixar,
-            max_workers=max_concorrentes,
-            desc="Download geral",
-        )
+        # dispara os downloads em paralelo (limitados pelo semáforo) e coleta True/False;
+        # o pool de processos valida os CRCs sem bloquear o loop de eventos
+        sem = asyncio.Semaphore(max_concorrentes)
+        connector = aiohttp.TCPConnector(limit=8, limit_per_host=8)
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=60, sock_read=60)
+        with ProcessPoolExecutor(
+            max_workers=max(1, (os.cpu_count() or 2) // 2)
+        ) as pool:
+            async with aiohttp.ClientSession(
+                headers=headers, connector=connector, timeout=timeout
+            ) as session:
+                async with asyncio.TaskGroup() as tg:
+                    tarefas = [
+                        tg.create_task(
+                            download_file(
+                                session, url, filename, *sondagens[url], sem, pool
+                            )
+                        )
+                        for url, filename in arquivos_para_baixar
+                    ]
 
         # soma os True para contar sucessos
-        success_count = sum(resultados)
+        success_count = sum(t.result() for t in tarefas)
 
         # imprime o resumo usando success_count
         print(
@@ -188,5 +452,5 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
     input("\nPressione Enter para sair.")
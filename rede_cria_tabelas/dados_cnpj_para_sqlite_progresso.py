@@ -3,91 +3,75 @@
 Script atualizado para importar arquivos da Receita Federal para SQLite com controle de progresso.
 
 Este script:
-- Descompacta os arquivos da Receita.
+- Lê os CSVs direto de dentro dos zips da Receita, sem descompactar para o disco.
 - Cria uma base SQLite com tabelas e índices.
 - Utiliza uma tabela _progresso para controlar o estado de cada etapa.
 - Permite reinício seguro em caso de falha, reexecutando apenas as etapas incompletas.
 """
 
-import os, sys, glob, time, zipfile, sqlite3, pandas as pd, sqlalchemy
-import dask.dataframe as dd
+import os, sys, glob, time, zipfile, sqlite3, pandas as pd
+import csv, io, fnmatch, queue, threading
 
 pasta_compactados = r"dados-publicos-zip"
 pasta_saida = r"dados-publicos"
 db_path = os.path.join(pasta_saida, 'cnpj.db')
 
-bApagaDescompactadosAposUso = True
+# conexão criada em main()
+conn = None
+cursor = None
 
 # Função para log com timestamp
 def log(msg):
     print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] {msg}")
 
-# Verificação e conexão inicial
-if not os.path.exists(pasta_saida):
-    os.makedirs(pasta_saida)
-
-db_exists = os.path.exists(db_path)
-conn = sqlite3.connect(db_path)
-cursor = conn.cursor()
-engine_url = f'sqlite:///{db_path}'
-
-if not db_exists:
-    log("Criando nova base de dados...")
-    conn.execute('''CREATE TABLE IF NOT EXISTS _progresso (
-        etapa TEXT PRIMARY KEY,
-        status TEXT,
-        data_execucao TEXT
-    )''')
-    conn.commit()
+def tune(conn):
+    """Ajusta PRAGMAs para carga em massa: WAL evita um fsync por commit e,
+    como este script é o único escritor da base, locking_mode=EXCLUSIVE
+    pega o lock do arquivo uma vez só em vez de uma vez por transação
+    (precisa vir antes do journal_mode)."""
+    for p in ('locking_mode=EXCLUSIVE', 'journal_mode=WAL', 'synchronous=NORMAL',
+              'temp_store=MEMORY', 'cache_size=-262144', 'mmap_size=30000000000',
+              'wal_autocheckpoint=10000'):
+        conn.execute('PRAGMA ' + p)
+
+def libera_lock_exclusivo(conn):
+    """Volta ao modo de lock normal; o lock só é solto na próxima leitura."""
+    conn.execute('PRAGMA locking_mode=NORMAL')
+    conn.execute('SELECT * FROM sqlite_master LIMIT 1').fetchone()
+
+def checkpoint_wal(conn):
+    """Descarrega o WAL na base principal e trunca o arquivo -wal."""
+    resultado = conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+    if resultado and resultado[0] != 0:
+        log(f"Aviso: wal_checkpoint incompleto (busy/log/checkpointed = {resultado})")
 
 def etapa_concluida(etapa):
     res = cursor.execute("SELECT status FROM _progresso WHERE etapa=?", (etapa,)).fetchone()
     return res and res[0] == 'ok'
 
 def marcar_etapa_concluida(etapa):
+    # sem commit aqui: o marcador entra na transação do carregador que chamou,
+    # para que dados e progresso sejam gravados atomicamente em um só fsync
     cursor.execute("INSERT OR REPLACE INTO _progresso (etapa, status, data_execucao) VALUES (?, 'ok', datetime('now'))", (etapa,))
-    conn.commit()
-
-# 1. Descompactar arquivos zip
-etapa = 'descompactar'
-if not etapa_concluida(etapa):
-    log("Iniciando etapa: descompactar")
-    arquivos_zip = list(glob.glob(os.path.join(pasta_compactados, r'*.zip')))
-    if len(arquivos_zip) != 37:
-        r = input(f'A pasta {pasta_compactados} deveria conter 37 arquivos zip. Encontrado {len(arquivos_zip)}. Prosseguir? (y/n) ')
-        if r.lower() != 'y':
-            sys.exit(1)
-    for arq in arquivos_zip:
-        log(f"Descompactando: {arq}")
-        with zipfile.ZipFile(arq, 'r') as zip_ref:
-            zip_ref.extractall(pasta_saida)
-    marcar_etapa_concluida(etapa)
-else:
-    log("Etapa já concluída: descompactar, pulando.")
 
 # 2. Códigos auxiliares
-def carregaTabelaCodigo(ext, nomeTabela):
-    etapa = f'codigo_{nomeTabela}'
-    if etapa_concluida(etapa):
-        log(f"Etapa já concluída: código_{nomeTabela}, pulando.")
-        return
-    arquivo = glob.glob(os.path.join(pasta_saida, '*' + ext))[0]
-    log(f"Iniciando etapa: código_{nomeTabela}")
+CODIGOS = {
+    '.CNAECSV': 'cnae',
+    '.MOTICSV': 'motivo',
+    '.MUNICCSV': 'municipio',
+    '.NATJUCSV': 'natureza_juridica',
+    '.PAISCSV': 'pais',
+    '.QUALSCSV': 'qualificacao_socio',
+}
+
+def carregaTabelaCodigo(nomeTabela, linhas):
+    # tabelas de código têm poucos milhares de linhas; csv.reader + executemany
+    # dispensa o custo de montar um DataFrame e participa da transação por zip
     log(f"Importando código: {nomeTabela}")
-    df = pd.read_csv(arquivo, sep=';', dtype=str, encoding='latin1', header=None, names=['codigo','descricao'])
-    df.to_sql(nomeTabela, conn, if_exists='replace', index=None)
+    conn.execute(f'DROP TABLE IF EXISTS {nomeTabela}')
+    conn.execute(f'CREATE TABLE {nomeTabela} (codigo TEXT, descricao TEXT)')
+    conn.executemany(f'INSERT INTO {nomeTabela} VALUES (?,?)', linhas)
     conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{nomeTabela} ON {nomeTabela}(codigo);')
-    conn.commit()
-    if bApagaDescompactadosAposUso:
-        os.remove(arquivo)
-    marcar_etapa_concluida(etapa)
-
-carregaTabelaCodigo('.CNAECSV','cnae')
-carregaTabelaCodigo('.MOTICSV', 'motivo')
-carregaTabelaCodigo('.MUNICCSV', 'municipio')
-carregaTabelaCodigo('.NATJUCSV', 'natureza_juridica')
-carregaTabelaCodigo('.PAISCSV', 'pais')
-carregaTabelaCodigo('.QUALSCSV', 'qualificacao_socio')
 
 # 3. Criação e carga das tabelas grandes
 TABELAS = {
@@ -95,7 +79,8 @@ TABELAS = {
         'ext': '.EMPRECSV',
         'colunas': [
             'cnpj_basico', 'razao_social', 'natureza_juridica', 'qualificacao_responsavel',
-            'capital_social_str', 'porte_empresa', 'ente_federativo_responsavel']
+            'capital_social_str', 'porte_empresa', 'ente_federativo_responsavel'],
+        'post_index': ['cnpj_basico', 'razao_social']
     },
     'estabelecimento': {
         'ext': '.ESTABELE',
@@ -104,39 +89,172 @@ TABELAS = {
             'data_situacao_cadastral','motivo_situacao_cadastral','nome_cidade_exterior','pais',
             'data_inicio_atividades','cnae_fiscal','cnae_fiscal_secundaria','tipo_logradouro','logradouro',
             'numero','complemento','bairro','cep','uf','municipio','ddd1','telefone1','ddd2','telefone2',
-            'ddd_fax','fax','correio_eletronico','situacao_especial','data_situacao_especial']
+            'ddd_fax','fax','correio_eletronico','situacao_especial','data_situacao_especial'],
+        'post_index': ['cnpj_basico', 'nome_fantasia']
     },
     'socios_original': {
         'ext': '.SOCIOCSV',
         'colunas': [
             'cnpj_basico','identificador_de_socio','nome_socio','cnpj_cpf_socio','qualificacao_socio',
             'data_entrada_sociedade','pais','representante_legal','nome_representante',
-            'qualificacao_representante_legal','faixa_etaria']
+            'qualificacao_representante_legal','faixa_etaria'],
+        'post_index': ['cnpj_basico']
     },
     'simples': {
         'ext': '.SIMPLES.CSV.*',
         'colunas': [
             'cnpj_basico','opcao_simples','data_opcao_simples','data_exclusao_simples',
-            'opcao_mei','data_opcao_mei','data_exclusao_mei']
+            'opcao_mei','data_opcao_mei','data_exclusao_mei'],
+        'post_index': ['cnpj_basico']
     }
 }
 
-for tabela, meta in TABELAS.items():
-    etapa = f'carga_{tabela}'
-    if etapa_concluida(etapa):
-        log(f"Etapa já concluída: carga_{tabela}, pulando.")
-        continue
-    conn.execute(f'DROP TABLE IF EXISTS {tabela}')
+def destino_do_arquivo(nome):
+    """Identifica a tabela de destino de um membro do zip."""
+    for ext, nomeTabela in CODIGOS.items():
+        if nome.endswith(ext):
+            return ('codigo', nomeTabela)
+    for tabela, meta in TABELAS.items():
+        if fnmatch.fnmatch(nome, '*' + meta['ext']):
+            return ('tabela', tabela)
+    return (None, None)
+
+def importa_chunk(tabela, chunk):
+    """Insere um chunk de linhas em uma das tabelas grandes.
+
+    Sem BEGIN/COMMIT aqui: roda dentro da transação por zip do consumidor."""
+    colunas = TABELAS[tabela]['colunas']
+    sql_insert = f"INSERT INTO {tabela} VALUES ({','.join('?' * len(colunas))})"
+    conn.executemany(sql_insert, chunk.itertuples(index=False, name=None))
+
+def produz_zips(arquivos_zip, fila):
+    """Produtor: lê cada membro direto de dentro do zip e enfileira chunks
+    já parseados — o CSV descompactado nunca toca o disco.
+
+    A descompactação (DEFLATE) e o parse do CSV rodam nesta thread, em
+    paralelo com as gravações no SQLite feitas pelo consumidor; o maxsize
+    da fila limita a memória em uso."""
+    try:
+        for zip_path in arquivos_zip:
+            with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+                for nome in zip_ref.namelist():
+                    tipo, destino = destino_do_arquivo(nome)
+                    if tipo == 'codigo':
+                        with zip_ref.open(nome) as raw:
+                            texto = io.TextIOWrapper(raw, encoding='latin1', newline='')
+                            linhas = list(csv.reader(texto, delimiter=';'))
+                        fila.put(('codigo', destino, linhas))
+                    elif tipo == 'tabela':
+                        log(f"Importando {zip_path}/{nome} para {destino}")
+                        colunas = TABELAS[destino]['colunas']
+                        with zip_ref.open(nome) as raw:
+                            for chunk in pd.read_csv(raw, sep=';', header=None,
+                                                     names=colunas, encoding='latin1',
+                                                     dtype=str, engine='c',
+                                                     na_filter=False, chunksize=200_000):
+                                fila.put(('chunk', destino, chunk))
+                    else:
+                        log(f"Aviso: arquivo sem destino conhecido: {nome}")
+            fila.put(('fim_zip', zip_path, None))
+    except BaseException as e:
+        # zip corrompido, CSV inválido etc.: repassa para o consumidor, que
+        # desfaz a transação parcial e encerra o script com erro
+        fila.put(('erro', None, e))
+    finally:
+        fila.put(None)
+
+def main():
+    global conn, cursor
+
+    # Verificação e conexão inicial
+    if not os.path.exists(pasta_saida):
+        os.makedirs(pasta_saida)
+
+    db_exists = os.path.exists(db_path)
+    conn = sqlite3.connect(db_path)
+    if not db_exists:
+        # page_size precisa ser definido antes da primeira gravação na base
+        conn.execute('PRAGMA page_size=32768')
+    tune(conn)
+    cursor = conn.cursor()
+
+    if not db_exists:
+        log("Criando nova base de dados...")
+        conn.execute('''CREATE TABLE IF NOT EXISTS _progresso (
+            etapa TEXT PRIMARY KEY,
+            status TEXT,
+            data_execucao TEXT
+        )''')
+        conn.commit()
+
+    # 1. Pipeline ler do zip -> carregar, zip a zip.
+    # Nada é descompactado para o disco: o produtor lê e parseia os membros
+    # de dentro dos zips enquanto o consumidor (esta thread, dona da
+    # conexão) grava os chunks anteriores no SQLite.
+    arquivos_zip = sorted(glob.glob(os.path.join(pasta_compactados, r'*.zip')))
+    if len(arquivos_zip) != 37:
+        r = input(f'A pasta {pasta_compactados} deveria conter 37 arquivos zip. Encontrado {len(arquivos_zip)}. Prosseguir? (y/n) ')
+        if r.lower() != 'y':
+            sys.exit(1)
+
+    zips_pendentes = [z for z in arquivos_zip
+                      if not etapa_concluida(f'carga_zip:{os.path.basename(z)}')]
+    for z in arquivos_zip:
+        if z not in zips_pendentes:
+            log(f"Zip já processado: {os.path.basename(z)}, pulando.")
+
+    # cria as tabelas grandes; só recomeça do zero se nenhum zip foi processado
+    if len(zips_pendentes) == len(arquivos_zip):
+        for tabela, meta in TABELAS.items():
+            conn.execute(f'DROP TABLE IF EXISTS {tabela}')
+    for tabela, meta in TABELAS.items():
+        sql_cols = ', '.join([f'{c} TEXT' for c in meta['colunas']])
+        conn.execute(f'CREATE TABLE IF NOT EXISTS {tabela} ({sql_cols})')
     conn.commit()
-    sql_cols = ', '.join([f'{c} TEXT' for c in meta['colunas']])
-    conn.execute(f'CREATE TABLE {tabela} ({sql_cols})')
-    arquivos = glob.glob(os.path.join(pasta_saida, '*' + meta['ext']))
-    for arq in arquivos:
-        log(f"Importando {arq} para {tabela}")
-        ddf = dd.read_csv(arq, sep=';', header=None, names=meta['colunas'], encoding='latin1', dtype=str, na_filter=None)
-        ddf.to_sql(tabela, engine_url, index=None, if_exists='append', dtype=sqlalchemy.sql.sqltypes.TEXT)
-        if bApagaDescompactadosAposUso:
-            os.remove(arq)
-    marcar_etapa_concluida(etapa)
-
-log('Script finalizado com sucesso.')
+
+    if zips_pendentes:
+        fila = queue.Queue(maxsize=4)
+        produtor = threading.Thread(target=produz_zips,
+                                    args=(zips_pendentes, fila), daemon=True)
+        produtor.start()
+        while True:
+            item = fila.get()
+            if item is None:
+                break
+            tipo, destino, dados = item
+            if tipo == 'codigo':
+                carregaTabelaCodigo(destino, dados)
+            elif tipo == 'chunk':
+                importa_chunk(destino, dados)
+            elif tipo == 'fim_zip':
+                # commit por zip: dados e marcador de progresso são
+                # confirmados juntos (ou desfeitos juntos em caso de falha)
+                marcar_etapa_concluida(f'carga_zip:{os.path.basename(destino)}')
+                conn.commit()
+            elif tipo == 'erro':
+                # falha no produtor: descarta as linhas do zip incompleto em
+                # vez de deixá-las na transação aberta, e falha em voz alta
+                conn.rollback()
+                raise dados
+        produtor.join()
+
+    # 2. Índices só depois da carga completa: inserir sem árvore-B para manter
+    # custa O(N); construir o índice no final é uma única ordenação em massa
+    for tabela, meta in TABELAS.items():
+        etapa = f'indices_{tabela}'
+        if not meta.get('post_index') or etapa_concluida(etapa):
+            continue
+        conn.execute('PRAGMA cache_size=-1048576')  # mais RAM para a ordenação
+        with conn:
+            for coluna in meta['post_index']:
+                log(f"Criando índice idx_{tabela}_{coluna}")
+                conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{tabela}_{coluna} ON {tabela}({coluna})')
+            marcar_etapa_concluida(etapa)
+        conn.execute('PRAGMA cache_size=-262144')
+        checkpoint_wal(conn)
+
+    libera_lock_exclusivo(conn)
+    log('Script finalizado com sucesso.')
+
+if __name__ == '__main__':
+    main()